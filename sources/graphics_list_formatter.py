@@ -1,8 +1,8 @@
 from enum import Enum
 from typing import Dict, Tuple, List
-from datetime import datetime
 
-from pytz import timezone, utc
+from ciso8601 import parse_datetime
+from pytz import timezone
 
 from manager_environment import EnvironmentManager as EM
 from manager_file import FileManager as FM
@@ -87,14 +87,14 @@ async def make_commit_day_time_list(time_zone: str, repositories: Dict, commit_d
     stats = str()
     day_times = [0] * 4  # 0 - 6, 6 - 12, 12 - 18, 18 - 24
     week_days = [0] * 7  # Monday, Tuesday, Wednesday, Thursday, Friday, Saturday, Sunday
+    user_timezone = timezone(time_zone)
 
     for repository in repositories:
         if repository["name"] not in commit_dates.keys():
             continue
 
         for committed_date in [commit_date for branch in commit_dates[repository["name"]].values() for commit_date in branch.values()]:
-            local_date = datetime.strptime(committed_date, "%Y-%m-%dT%H:%M:%SZ")
-            date = local_date.replace(tzinfo=utc).astimezone(timezone(time_zone))
+            date = parse_datetime(committed_date).astimezone(user_timezone)
 
             day_times[date.hour // 6] += 1
             week_days[date.isoweekday() - 1] += 1
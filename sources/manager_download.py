@@ -1,14 +1,23 @@
-from asyncio import Task
+from asyncio import Task, gather, sleep
 from hashlib import md5
-from json import dumps
+from itertools import islice
 from string import Template
-from typing import Awaitable, Dict, Callable, Optional, List, Tuple
+from time import time
+from typing import AsyncIterator, Awaitable, Dict, Callable, Optional, List, Tuple
 
-from httpx import AsyncClient
-from yaml import safe_load
+from aiolimiter import AsyncLimiter
+from httpx import AsyncClient, Limits
+from orjson import loads
+from yaml import load as load_yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # PyYAML built without libyaml bindings
+    from yaml import SafeLoader
 
 from manager_environment import EnvironmentManager as EM
 from manager_debug import DebugManager as DBM
+from manager_file import FileManager as FM
 
 
 GITHUB_API_QUERIES = {
@@ -60,13 +69,32 @@ GITHUB_API_QUERIES = {
     }
 }
 """,
-    # Query to collect info about branches in the given repository, including: names.
-    "repo_branch_list": """
+    # Query to collect info about branches in the given repository together with the first page of user commits to each of them.
+    # Includes: branch names, head commit ids and requested commit fields (inserted instead of `$commit_fields`).
+    # History of the branches that has more than one page should be fetched with "repo_branches_commit_list" query.
+    # Branch history can be limited with `$since` placeholder, that should contain either `since` argument (with leading comma) or be empty.
+    "repo_branches_with_commits": """
 {
     repository(owner: "$owner", name: "$name") {
         refs(refPrefix: "refs/heads/", orderBy: {direction: DESC, field: TAG_COMMIT_DATE}, $pagination) {
             nodes {
                 name
+                target {
+                    oid
+                    ... on Commit {
+                        history(author: { id: "$id" }$since, first: 100) {
+                            nodes {
+                                ... on Commit {
+                                    $commit_fields
+                                }
+                            }
+                            pageInfo {
+                                endCursor
+                                hasNextPage
+                            }
+                        }
+                    }
+                }
             }
             pageInfo {
                 endCursor
@@ -76,20 +104,34 @@ GITHUB_API_QUERIES = {
     }
 }
 """,
-    # Query to collect info about user commits to given repository, including: commit date, additions and deletions numbers.
-    "repo_commit_list": """
+    # Query to collect info about user commits to several branches of given repository at once.
+    # Branch history blocks (see `GITHUB_API_BRANCH_HISTORY`) are generated for every branch and inserted instead of `$branches`.
+    "repo_branches_commit_list": """
 {
-    repository(owner: "$owner", name: "$name") {
-        ref(qualifiedName: "refs/heads/$branch") {
+    repository(owner: "$owner", name: "$name") {$branches
+    }
+}
+""",
+    # Query to hide outdated PR comment.
+    "hide_outdated_comment": """
+mutation {
+    minimizeComment(input: {classifier: OUTDATED, subjectId: "$id"}) {
+        clientMutationId
+    }
+}
+""",
+}
+
+# Aliased branch history block of "repo_branches_commit_list" query, including requested commit fields (inserted instead of `$commit_fields`).
+# Branch history can be limited with `$since` placeholder, that should contain either `since` argument (with leading comma) or be empty.
+GITHUB_API_BRANCH_HISTORY = """
+        $alias: ref(qualifiedName: "refs/heads/$branch") {
             target {
                 ... on Commit {
-                    history(author: { id: "$id" }, $pagination) {
+                    history(author: { id: "$id" }$since, $pagination) {
                         nodes {
                             ... on Commit {
-                                additions
-                                deletions
-                                committedDate
-                                oid
+                                $commit_fields
                             }
                         }
                         pageInfo {
@@ -99,19 +141,20 @@ GITHUB_API_QUERIES = {
                     }
                 }
             }
-        }
-    }
-}
-""",
-    # Query to hide outdated PR comment.
-    "hide_outdated_comment": """
-mutation {
-    minimizeComment(input: {classifier: OUTDATED, subjectId: "$id"}) {
-        clientMutationId
-    }
-}
-""",
-}
+        }"""
+
+MAX_BATCHED_BRANCHES = 5  # Maximum number of branches, which history is requested in one batched query (100 commits each).
+# GitHub GraphQL API hourly budget, requests may burst up to it and are throttled only once it is used up.
+# NB! Requests are counted, not GraphQL points, points budget is guarded by `GITHUB_RATE_LIMIT_THRESHOLD` check.
+GITHUB_REQUESTS_PER_HOUR = 5000
+GITHUB_RATE_LIMIT_THRESHOLD = 100  # Number of remaining GitHub API points, below which requests wait for the rate limit reset.
+
+GRAPHQL_CACHE_DIR = ".gql_cache"  # Directory for GraphQL responses cache (inside of assets directory), used in debug runs only.
+GRAPHQL_CACHE_TTL = 24 * 60 * 60  # GraphQL responses cache expiration time (in seconds).
+
+# GraphQL query templates, parsed once instead of on every request.
+_COMPILED_QUERIES = {name: Template(query) for name, query in GITHUB_API_QUERIES.items()}
+_COMPILED_BRANCH_HISTORY = Template(GITHUB_API_BRANCH_HISTORY)
 
 
 async def init_download_manager(user_login: str):
@@ -124,13 +167,18 @@ async def init_download_manager(user_login: str):
 
 
 class DownloadManager:
-    _client = AsyncClient(timeout=60.0)
+    _client = AsyncClient(timeout=60.0, http2=True, limits=Limits(max_connections=50, max_keepalive_connections=50, keepalive_expiry=30.0))
+    _GITHUB_HEADERS = {"Authorization": f"Bearer {EM.GH_TOKEN}"}
+    _github_limiter = AsyncLimiter(max_rate=GITHUB_REQUESTS_PER_HOUR, time_period=60 * 60)
     _REMOTE_RESOURCES_CACHE = {}
 
+    _rate_limit_remaining: Optional[int] = None
+    _rate_limit_reset: float = 0
+
     @staticmethod
     async def load_remote_resources(**resources: str):
-        for resource, url in resources.items():
-            DownloadManager._REMOTE_RESOURCES_CACHE[resource] = await DownloadManager._client.get(url)
+        responses = await gather(*[DownloadManager._client.get(url) for url in resources.values()])
+        DownloadManager._REMOTE_RESOURCES_CACHE.update(zip(resources.keys(), responses))
 
     @staticmethod
     async def close_remote_resources():
@@ -139,6 +187,7 @@ class DownloadManager:
                 resource.cancel()
             elif isinstance(resource, Awaitable):
                 await resource
+        await DownloadManager._client.aclose()
 
     @staticmethod
     async def _get_remote_resource(resource: str, convertor: Optional[Callable[[bytes], Dict]]) -> Optional[Dict]:
@@ -148,7 +197,7 @@ class DownloadManager:
         DBM.g(f"\tQuery '{resource}' {'finished' if isinstance(res, Task) else 'loaded from cache'}!")
 
         if res.status_code == 200:
-            return convertor(res.content) if convertor else res.json()
+            return convertor(res.content) if convertor else loads(res.content)
         elif res.status_code in (201, 202):
             DBM.w(f"\tQuery '{resource}' returned status code {res.status_code}")
             return None
@@ -161,56 +210,165 @@ class DownloadManager:
 
     @staticmethod
     async def get_remote_yaml(resource: str) -> Optional[Dict]:
-        return await DownloadManager._get_remote_resource(resource, safe_load)
+        return await DownloadManager._get_remote_resource(resource, lambda content: load_yaml(content, Loader=SafeLoader))
+
+    @staticmethod
+    async def _wait_for_rate_limit():
+        """
+        Wait for GitHub rate limit reset if less than `GITHUB_RATE_LIMIT_THRESHOLD` points are remaining.
+        The remaining points are taken from the headers of the latest GitHub API response.
+        """
+        if DownloadManager._rate_limit_remaining is not None and DownloadManager._rate_limit_remaining < GITHUB_RATE_LIMIT_THRESHOLD:
+            delay = DownloadManager._rate_limit_reset - time()
+            if delay > 0:
+                DBM.w(f"\tGitHub rate limit is almost exhausted, waiting {int(delay)} seconds for reset...")
+                await sleep(delay)
+            DownloadManager._rate_limit_remaining = None
 
     @staticmethod
     async def _fetch_graphql_query(query: str, retries_count: int = 10, **kwargs) -> Dict:
-        headers = {"Authorization": f"Bearer {EM.GH_TOKEN}"}
         #print(query)
-        res = await DownloadManager._client.post(
-            "https://api.github.com/graphql",
-            json={"query": Template(GITHUB_API_QUERIES[query]).substitute(kwargs)},
-            headers=headers,
-        )
+        await DownloadManager._wait_for_rate_limit()
+        async with DownloadManager._github_limiter:
+            res = await DownloadManager._client.post(
+                "https://api.github.com/graphql",
+                json={"query": _COMPILED_QUERIES[query].substitute(kwargs)},
+                headers=DownloadManager._GITHUB_HEADERS,
+            )
+        if "X-RateLimit-Remaining" in res.headers:
+            DownloadManager._rate_limit_remaining = int(res.headers["X-RateLimit-Remaining"])
+            DownloadManager._rate_limit_reset = float(res.headers.get("X-RateLimit-Reset", 0))
+
         if res.status_code == 200:
-            return res.json()
+            response = loads(res.content)
+            if "errors" in response:
+                errors = "; ".join(error.get("message", str(error)) for error in response["errors"])
+                if response.get("data") is None and retries_count > 0:
+                    DBM.w(f"\tQuery '{query}' failed with errors: {errors}, retrying...")
+                    return await DownloadManager._fetch_graphql_query(query, retries_count - 1, **kwargs)
+                elif response.get("data") is None:
+                    raise Exception(f"Query '{query}' failed with errors: {errors}")
+                DBM.w(f"\tQuery '{query}' returned partial data with errors: {errors}")
+            return response
         elif res.status_code == 502 and retries_count > 0:
             return await DownloadManager._fetch_graphql_query(query, retries_count - 1, **kwargs)
+        elif res.status_code in (403, 429) and "Retry-After" in res.headers and retries_count > 0:
+            DBM.w(f"\tQuery '{query}' hit secondary rate limit, retrying in {res.headers['Retry-After']} seconds...")
+            await sleep(float(res.headers["Retry-After"]))
+            return await DownloadManager._fetch_graphql_query(query, retries_count - 1, **kwargs)
         else:
             raise Exception(f"Query '{query}' failed with code {res.status_code}: {res.text}")
 
     @staticmethod
     def _find_pagination_and_data_list(response: Dict) -> Tuple[List, Dict]:
-        if "nodes" in response and "pageInfo" in response:
-            return response["nodes"], response["pageInfo"]
-        elif len(response) == 1 and isinstance(list(response.values())[0], dict):
-            return DownloadManager._find_pagination_and_data_list(list(response.values())[0])
-        else:
+        while True:
+            if "nodes" in response and "pageInfo" in response:
+                return response["nodes"], response["pageInfo"]
+            if len(response) == 1:
+                value = next(iter(response.values()))
+                if isinstance(value, dict):
+                    response = value
+                    continue
             return [], {"hasNextPage": False}
 
     @staticmethod
-    async def _fetch_graphql_paginated(query: str, **kwargs) -> List[Dict]:
+    async def _fetch_graphql_paginated_iter(query: str, page_size: int = 100, **kwargs) -> AsyncIterator[List[Dict]]:
         #(query)
-        kwargs["first"] = 100  # GitHub's hard limit
-        initial = await DownloadManager._fetch_graphql_query(query, **kwargs, pagination='first: 100')
-        nodes, page_info = DownloadManager._find_pagination_and_data_list(initial)
+        # Page size is 100 at most (GitHub's hard limit), smaller pages should be used for queries with nested connections.
+        initial = await DownloadManager._fetch_graphql_query(query, **kwargs, pagination=f"first: {page_size}")
+        nodes, page_info = DownloadManager._find_pagination_and_data_list(initial["data"])
+        yield nodes
 
         while page_info.get("hasNextPage"):
             after = page_info.get("endCursor")
-            paginated = await DownloadManager._fetch_graphql_query(query, **kwargs, pagination=f'first: 100, after: "{after}"')
-            new_nodes, page_info = DownloadManager._find_pagination_and_data_list(paginated)
-            nodes.extend(new_nodes)
+            paginated = await DownloadManager._fetch_graphql_query(query, **kwargs, pagination=f'first: {page_size}, after: "{after}"')
+            nodes, page_info = DownloadManager._find_pagination_and_data_list(paginated["data"])
+            yield nodes
 
-        return nodes
+    @staticmethod
+    async def _fetch_graphql_paginated(query: str, **kwargs) -> List[Dict]:
+        return [node async for nodes in DownloadManager._fetch_graphql_paginated_iter(query, **kwargs) for node in nodes]
 
     @staticmethod
-    async def get_remote_graphql(query: str, **kwargs) -> Dict:
-        key = f"{query}_{md5(dumps(kwargs, sort_keys=True).encode('utf-8')).hexdigest()}"
-        if key not in DownloadManager._REMOTE_RESOURCES_CACHE:
-            if "$pagination" in GITHUB_API_QUERIES[query]:
+    async def _fetch_graphql_batched_iter(query: str, branches: List[str], cursors: Optional[List[str]] = None, **kwargs) -> AsyncIterator[Tuple[str, List]]:
+        """
+        Fetch paginated history of several branches in one query per page.
+        Every branch is queried under its own alias, up to `MAX_BATCHED_BRANCHES` branches per query.
+        Branches that have no more pages are excluded from the following queries.
+
+        :param query: Query name, the query should contain `$branches` placeholder, that is filled with `GITHUB_API_BRANCH_HISTORY` blocks.
+        :param branches: Names of the branches to query.
+        :param cursors: Cursors to start history of each of the branches after, history is fetched from the start if None.
+        :returns: Async iterator over branch names and pages of their history nodes.
+        """
+        pending = dict()
+        for ind, branch in enumerate(branches):
+            pending[f"branch{ind}"] = (branch, "first: 100" if cursors is None else f'first: 100, after: "{cursors[ind]}"')
+
+        while len(pending) > 0:
+            batch = dict(islice(pending.items(), MAX_BATCHED_BRANCHES))
+            aliases = [_COMPILED_BRANCH_HISTORY.substitute(kwargs, alias=alias, branch=b, pagination=p) for alias, (b, p) in batch.items()]
+            response = await DownloadManager._fetch_graphql_query(query, **kwargs, branches="".join(aliases))
+            repository = response["data"].get("repository") or dict()
+
+            for alias, (branch, _) in batch.items():
+                del pending[alias]
+                if repository.get(alias) is None:
+                    DBM.w(f"\tQuery '{query}' returned no history for branch '{branch}', skipping it.")
+                    continue
+                nodes, page_info = DownloadManager._find_pagination_and_data_list(repository[alias])
+                if page_info.get("hasNextPage"):
+                    pending[alias] = (branch, f'first: 100, after: "{page_info.get("endCursor")}"')
+                yield branch, nodes
+
+    @staticmethod
+    async def _fetch_graphql_batched(query: str, branches: List[str], **kwargs) -> Dict[str, List[Dict]]:
+        results = {branch: list() for branch in branches}
+        async for branch, nodes in DownloadManager._fetch_graphql_batched_iter(query, branches, **kwargs):
+            results[branch].extend(nodes)
+        return results
+
+    @staticmethod
+    async def _fetch_graphql_cached(query: str, key: Tuple, **kwargs) -> Dict:
+        cache_file = f"{GRAPHQL_CACHE_DIR}/{md5(repr(key).encode('utf-8')).hexdigest()}.pick"
+        cacheable = EM.DEBUG_RUN and not GITHUB_API_QUERIES[query].lstrip().startswith("mutation")
+        result = FM.cache_binary(cache_file, assets=True, max_age=GRAPHQL_CACHE_TTL) if cacheable else None
+        if result is None:
+            if "branches" in kwargs:
+                result = await DownloadManager._fetch_graphql_batched(query, **kwargs)
+            elif "$pagination" in GITHUB_API_QUERIES[query]:
                 result = await DownloadManager._fetch_graphql_paginated(query, **kwargs)
                 #print(f"Fetched {len(result)} results from {query}!")
             else:
                 result = await DownloadManager._fetch_graphql_query(query, **kwargs)
-            DownloadManager._REMOTE_RESOURCES_CACHE[key] = result
+            if cacheable:
+                FM.cache_binary(cache_file, result, assets=True)
+        return result
+
+    @staticmethod
+    async def get_remote_graphql(query: str, **kwargs) -> Dict:
+        key = (query,) + tuple(sorted((name, tuple(value) if isinstance(value, list) else value) for name, value in kwargs.items()))
+        if key not in DownloadManager._REMOTE_RESOURCES_CACHE:
+            DownloadManager._REMOTE_RESOURCES_CACHE[key] = await DownloadManager._fetch_graphql_cached(query, key, **kwargs)
         return DownloadManager._REMOTE_RESOURCES_CACHE[key]
+
+    @staticmethod
+    async def get_remote_graphql_iter(query: str, **kwargs) -> AsyncIterator:
+        """
+        Iterate over paginated query result page by page, without keeping the whole result in memory.
+        The pages are lists of nodes, for queries with `branches` argument they are tuples of branch name and list of nodes.
+        In debug runs the result is loaded with `get_remote_graphql` instead, so that it is cached.
+
+        :param query: Query name.
+        :returns: Async iterator over the result pages.
+        """
+        if EM.DEBUG_RUN:
+            result = await DownloadManager.get_remote_graphql(query, **kwargs)
+            for page in result.items() if "branches" in kwargs else [result]:
+                yield page
+        elif "branches" in kwargs:
+            async for page in DownloadManager._fetch_graphql_batched_iter(query, **kwargs):
+                yield page
+        else:
+            async for page in DownloadManager._fetch_graphql_paginated_iter(query, **kwargs):
+                yield page
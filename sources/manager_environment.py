@@ -8,7 +8,7 @@ class EnvironmentManager:
     The others have a provided default value.
     For all boolean variables a 'truthy'-list is checked (not only true/false, but also 1, t, y and yes are accepted).
     List variable `IGNORED_REPOS` is split and parsed.
-    Integer variable `SYMBOL_VERSION` is parsed.
+    Integer variables `SYMBOL_VERSION` and `COMMIT_HISTORY_YEARS` are parsed.
     """
 
     _TRUTHY = ["true", "1", "t", "y", "yes"]
@@ -45,6 +45,7 @@ class EnvironmentManager:
     UPDATED_DATE_FORMAT = getenv("INPUT_UPDATED_DATE_FORMAT", "%d/%m/%Y %H:%M:%S")
     IGNORED_REPOS = getenv("INPUT_IGNORED_REPOS", "").replace(" ", "").split(",")
     SYMBOL_VERSION = int(getenv("INPUT_SYMBOL_VERSION"))
+    COMMIT_HISTORY_YEARS = int(getenv("INPUT_COMMIT_HISTORY_YEARS", "0"))
 
     DEBUG_LOGGING = getenv("INPUT_DEBUG_LOGGING", "0").lower() in _TRUTHY
     DEBUG_RUN = getenv("DEBUG_RUN", "False").lower() in _TRUTHY
@@ -1,6 +1,8 @@
-from os.path import join, isfile, dirname
+from os import makedirs
+from os.path import join, isfile, dirname, getmtime
 from pickle import load as load_pickle, dump as dump_pickle
 from json import load as load_json
+from time import time
 from typing import Dict, Optional, Any
 
 from manager_environment import EnvironmentManager as EM
@@ -59,18 +61,24 @@ class FileManager:
             file.write(content)
 
     @staticmethod
-    def cache_binary(name: str, content: Optional[Any] = None, assets: bool = False) -> Optional[Any]:
+    def cache_binary(name: str, content: Optional[Any] = None, assets: bool = False, max_age: Optional[float] = None) -> Optional[Any]:
         """
         Save binary output file if provided or read if content is None.
+        Missing directories are created on saving.
 
         :param name: File name.
         :param content: File content (utf-8 string) or None.
         :param assets: True for saving to 'assets' directory, false otherwise.
+        :param max_age: Maximum age of the file in seconds when reading, files that are older are ignored, unlimited if None.
         :returns: File cache contents if content is None, None otherwise.
         """
         name = join(FileManager.ASSETS_DIR, name) if assets else name
         if content is None and not isfile(name):
             return None
+        if content is None and max_age is not None and time() - getmtime(name) > max_age:
+            return None
+        if content is not None and dirname(name) != "":
+            makedirs(dirname(name), exist_ok=True)
 
         with open(name, "rb" if content is None else "wb") as file:
             if content is None:
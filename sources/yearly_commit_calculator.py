@@ -1,8 +1,8 @@
-from asyncio import sleep
+from asyncio import Semaphore, gather
+from collections import defaultdict
 from json import dumps
-from re import search
 from datetime import datetime
-from typing import Dict, Tuple
+from typing import AsyncIterator, Dict, List, Tuple
 
 from manager_download import DownloadManager as DM
 from manager_environment import EnvironmentManager as EM
@@ -11,6 +11,12 @@ from manager_file import FileManager as FM
 from manager_debug import DebugManager as DBM
 
 
+MAX_CONCURRENT_REPOS = 10  # Number of repositories, processed at the same time.
+BRANCHES_PAGE_SIZE = 5  # Number of branches, requested together with their first page of commit history (100 commits each).
+COMMIT_TOTAL_FIELDS = "additions deletions committedDate"  # Commit fields, required for yearly commit stats.
+COMMIT_DATE_FIELDS = f"{COMMIT_TOTAL_FIELDS} oid"  # Commit fields, required for commit dates collection as well.
+
+
 async def calculate_commit_data(repositories: Dict) -> Tuple[Dict, Dict]:
     """
     Calculate commit data by years.
@@ -28,13 +34,20 @@ async def calculate_commit_data(repositories: Dict) -> Tuple[Dict, Dict]:
         else:
             DBM.w("No cached commit data found, recalculating...")
 
-    yearly_data = dict()
+    semaphore = Semaphore(MAX_CONCURRENT_REPOS)
+    repositories = [repo for repo in repositories if repo["name"] not in EM.IGNORED_REPOS]
+    repo_data = await gather(*[_bounded_update(semaphore, ind, len(repositories), repo) for ind, repo in enumerate(repositories)])
+
+    yearly_data = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: {"add": 0, "del": 0})))
     date_data = dict()
-    for ind, repo in enumerate(repositories):
-        if repo["name"] not in EM.IGNORED_REPOS:
-            repo_name = "[private]" if repo["isPrivate"] else f"{repo['owner']['login']}/{repo['name']}"
-            DBM.i(f"\t{ind + 1}/{len(repositories)} Retrieving repo: {repo_name}")
-            await update_data_with_commit_stats(repo, yearly_data, date_data)
+    for repo, (commit_stats, commit_dates) in zip(repositories, repo_data):
+        for curr_year, quarter, lang, additions, deletions in commit_stats:
+            bucket = yearly_data[curr_year][quarter][lang]
+            bucket["add"] += additions
+            bucket["del"] += deletions
+        if len(commit_dates) > 0:
+            date_data.setdefault(repo["name"], {}).update(commit_dates)
+    yearly_data = {year: {quarter: dict(langs) for quarter, langs in quarters.items()} for year, quarters in yearly_data.items()}
     DBM.g("Commit data calculated!")
 
     if EM.DEBUG_RUN:
@@ -44,95 +57,119 @@ async def calculate_commit_data(repositories: Dict) -> Tuple[Dict, Dict]:
     return yearly_data, date_data
 
 
+async def _bounded_update(semaphore: Semaphore, ind: int, total: int, repo: Dict) -> Tuple[List[Tuple[int, int, str, int, int]], Dict]:
+    """
+    Collects commit stats from given repository, limiting number of repositories processed at the same time.
+
+    :param semaphore: Semaphore, shared by all the repository tasks.
+    :param ind: Repository index, used for logging.
+    :param total: Total repositories number, used for logging.
+    :param repo: Dictionary with information about the given repository.
+    :returns: Commit stats and commit dates of the repository, empty if the repository couldn't be retrieved.
+    """
+    async with semaphore:
+        repo_name = "[private]" if repo["isPrivate"] else f"{repo['owner']['login']}/{repo['name']}"
+        DBM.i(f"\t{ind + 1}/{total} Retrieving repo: {repo_name}")
+        try:
+            return await update_data_with_commit_stats(repo)
+        except Exception as e:
+            DBM.w(f"\t\tFailed to retrieve repo {repo_name}: {e}, skipping it.")
+            return list(), dict()
+
 
+async def _iterate_commit_pages(repo_details: Dict, collect_dates: bool, since: str) -> AsyncIterator[Tuple[str, List[Dict]]]:
     """
-    Updates yearly commit data with commits from given repository.
-    Skips update if the commit isn't related to any repository.
+    Iterates over pages of user commits to each branch of given repository.
+    First pages arrive together with branch list, the rest of the history is fetched in batched queries for branches that have more.
+    Branches pointing to the same commit have the same history, only one of them is iterated over.
+    NB! First history page is still downloaded for every branch, duplicates are only skipped for the following pages.
 
     :param repo_details: Dictionary with information about the given repository.
-    :param yearly_data: Yearly data dictionary to update.
-    :param date_data: Commit date dictionary to update.
+    :param collect_dates: True if commit ids are required, false for commit totals only.
+    :param since: History `since` argument (with leading comma) or empty string.
+    :returns: Async iterator over branch names and pages of their commits.
     """
     owner = repo_details["owner"]["login"]
-    branch_data = await DM.get_remote_graphql("repo_branch_list", owner=owner, name=repo_details["name"])
-    if len(branch_data) == 0:
-        DBM.w("\t\tSkipping repo.")
-        return
+    commit_fields = COMMIT_DATE_FIELDS if collect_dates else COMMIT_TOTAL_FIELDS
+    branch_heads = set()
+    next_cursors = dict()
+
+    branch_pages = DM.get_remote_graphql_iter(
+        "repo_branches_with_commits",
+        owner=owner,
+        name=repo_details["name"],
+        id=GHM.USER.node_id,
+        since=since,
+        commit_fields=commit_fields,
+        page_size=BRANCHES_PAGE_SIZE,
+    )
+    async for branch_data in branch_pages:
+        for branch in branch_data:
+            if branch["target"]["oid"] in branch_heads:
+                continue
+            branch_heads.add(branch["target"]["oid"])
 
-    for branch in branch_data:
-        commit_data = await DM.get_remote_graphql("repo_commit_list", owner=owner, name=repo_details["name"], branch=branch["name"], id=GHM.USER.node_id, first=100, after=0)
-        #print(f"Commit data for {branch['name']}...")
-        #print(commit_data)
-        #print("--------------------------------")
-        for commit in commit_data:
-            date = search(r"\d+-\d+-\d+", commit["committedDate"]).group()
-            curr_year = datetime.fromisoformat(date).year
-            quarter = (datetime.fromisoformat(date).month - 1) // 3 + 1
-
-            if repo_details["name"] not in date_data:
-                date_data[repo_details["name"]] = dict()
-            if branch["name"] not in date_data[repo_details["name"]]:
-                date_data[repo_details["name"]][branch["name"]] = dict()
-            date_data[repo_details["name"]][branch["name"]][commit["oid"]] = commit["committedDate"]
-
-            if repo_details["primaryLanguage"] is not None:
-                if curr_year not in yearly_data:
-                    yearly_data[curr_year] = dict()
-                if quarter not in yearly_data[curr_year]:
-                    yearly_data[curr_year][quarter] = dict()
-                if repo_details["primaryLanguage"]["name"] not in yearly_data[curr_year][quarter]:
-                    yearly_data[curr_year][quarter][repo_details["primaryLanguage"]["name"]] = {"add": 0, "del": 0}
-                yearly_data[curr_year][quarter][repo_details["primaryLanguage"]["name"]]["add"] += commit["additions"]
-                yearly_data[curr_year][quarter][repo_details["primaryLanguage"]["name"]]["del"] += commit["deletions"]
-
-        if not EM.DEBUG_RUN:
-            await sleep(0.4)
-async def update_data_with_commit_stats(repo_details: Dict, yearly_data: Dict, date_data: Dict):
-    owner = repo_details["owner"]["login"]
-    branch_data = await DM.get_remote_graphql("repo_branch_list", owner=owner, name=repo_details["name"])
-    if len(branch_data) == 0:
-        DBM.w("\t\tSkipping repo.")
-        return
+            history = branch["target"]["history"]
+            if history["pageInfo"]["hasNextPage"]:
+                next_cursors[branch["name"]] = history["pageInfo"]["endCursor"]
+            yield branch["name"], history["nodes"]
 
-    for branch in branch_data:
-        commit_data = await DM.get_remote_graphql(
-            "repo_commit_list",
+    if len(branch_heads) == 0:
+        DBM.w("\t\tSkipping repo.")
+    elif len(next_cursors) > 0:
+        commit_pages = DM.get_remote_graphql_iter(
+            "repo_branches_commit_list",
             owner=owner,
             name=repo_details["name"],
-            branch=branch["name"],
-            id=GHM.USER.node_id
+            branches=list(next_cursors.keys()),
+            cursors=list(next_cursors.values()),
+            id=GHM.USER.node_id,
+            since=since,
+            commit_fields=commit_fields,
         )
+        async for page in commit_pages:
+            yield page
+
+
+async def update_data_with_commit_stats(repo_details: Dict) -> Tuple[List[Tuple[int, int, str, int, int]], Dict]:
+    """
+    Collects commit stats from given repository.
+    History of all the branches is streamed page by page, collected data is returned instead of being written to shared dictionaries.
+
+    :param repo_details: Dictionary with information about the given repository.
+    :returns: List of (year, quarter, language, additions, deletions) tuples and commit date dictionary of the repository.
+    """
+    commit_dates = dict()
 
-        #print(f"\t\tFetching commit stats for branch '{branch['name']}' in repo '{repo_details['name']}'...")
-        #print(f"\t\t\t{len(commit_data)} commits found.")
+    # Commit dates are only used for commit time and week day stats, otherwise commit ids are not requested.
+    collect_dates = EM.SHOW_COMMIT or EM.SHOW_DAYS_OF_WEEK
+    # History older than the requested number of years is filtered out by GitHub, so that its pages aren't fetched at all.
+    since = f', since: "{datetime.now().year - EM.COMMIT_HISTORY_YEARS + 1}-01-01T00:00:00Z"' if EM.COMMIT_HISTORY_YEARS > 0 else ""
 
-        #print(commit_data)
-        
-        if not isinstance(commit_data, list):
-            #print(f"\t\tCommit fetch failed for branch '{branch['name']}' in repo '{repo_details['name']}'!")
-            #print(f"\t\tError: {commit_data}")
-            continue  # Skip this branch
+    primary_language = repo_details["primaryLanguage"]
+    lang = primary_language["name"] if primary_language is not None else None
 
+    # Commit stats are summed by quarter while pages are streamed, so that the whole history is never kept in memory.
+    quarter_stats = defaultdict(lambda: [0, 0])
+    async for branch_name, commit_data in _iterate_commit_pages(repo_details, collect_dates, since):
+        branch_dates = commit_dates.get(branch_name, dict())
         for commit in commit_data:
-            date_match = search(r"\d+-\d+-\d+", commit.get("committedDate", ""))
-            if not date_match:
+            committed_date = commit.get("committedDate")
+            if not committed_date:
                 continue
 
-            date = date_match.group()
-            curr_year = datetime.fromisoformat(date).year
-            quarter = (datetime.fromisoformat(date).month - 1) // 3 + 1
+            curr_year = int(committed_date[0:4])
+            quarter = (int(committed_date[5:7]) - 1) // 3 + 1
 
-            if repo_details["name"] not in date_data:
-                date_data[repo_details["name"]] = dict()
-            if branch["name"] not in date_data[repo_details["name"]]:
-                date_data[repo_details["name"]][branch["name"]] = dict()
-            date_data[repo_details["name"]][branch["name"]][commit["oid"]] = commit["committedDate"]
+            if collect_dates:
+                branch_dates[commit["oid"]] = committed_date
+            if lang is not None:
+                stats = quarter_stats[curr_year, quarter]
+                stats[0] += commit["additions"]
+                stats[1] += commit["deletions"]
 
-            if repo_details["primaryLanguage"] is not None:
-                lang = repo_details["primaryLanguage"]["name"]
-                yearly_data.setdefault(curr_year, {}).setdefault(quarter, {}).setdefault(lang, {"add": 0, "del": 0})
-                yearly_data[curr_year][quarter][lang]["add"] += commit["additions"]
-                yearly_data[curr_year][quarter][lang]["del"] += commit["deletions"]
+        if len(branch_dates) > 0:
+            commit_dates[branch_name] = branch_dates
 
-        if not EM.DEBUG_RUN:
-            await sleep(0.4)
\ No newline at end of file
+    commit_stats = [(curr_year, quarter, lang, additions, deletions) for (curr_year, quarter), (additions, deletions) in quarter_stats.items()]
+    return commit_stats, commit_dates